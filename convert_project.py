@@ -2,23 +2,28 @@
 
 """Convert a project from Eclipse NLS approach to a ResourceBundle approach.
 
-Requirements: Installed the Silver Surfer (ag).
+Requirements: Installed ripgrep (rg) or the Silver Surfer (ag).
 """
 
 import argparse
 import subprocess as sp
 import os
-import shlex
+import io
+import shutil
+import tempfile
+import mmap
+import locale
 import re
 import logging
-import functools
-import multiprocessing
-import concurrent.futures
-logging.basicConfig(level=logging.WARNING,
-                    format=' [%(levelname)-7s] (%(asctime)s) %(filename)s::%(lineno)d %(message)s',
-                    datefmt='%Y-%m-%d %H:%M:%S')
+try:
+    import ahocorasick # pyahocorasick, optional: only makes replacing faster
+except ImportError:
+    ahocorasick = None
 
 
+# keep the command line of a single rg call far below ARG_MAX
+MAX_FILES_PER_RG_CALL = 1000
+
 TEMPLATE_MESSAGE_VARIABLE = """{classname}.{variablename}"""
 TEMPLATE_MESSAGE_TOSTRING = """{classname}.getString("{variablename}")"""
 TEMPLATE_GETSTRING = """
@@ -39,9 +44,28 @@ parser.add_argument("--singleprocess", action="store_true",
 parser.add_argument("--test", action="store_true",
                     help="Run tests")
 
+def _rg(*args):
+    """Run ripgrep with the given arguments and return the lines it printed."""
+    proc = sp.run(["rg", *args], capture_output=True)
+    if proc.returncode > 1: # 1 only means that nothing matched
+        raise sp.CalledProcessError(proc.returncode, proc.args, proc.stdout, proc.stderr)
+    return paths_in_output(proc.stdout)
+
+
+def paths_in_output(output):
+    """Split the output of a search tool into paths, decoded like the file system does.
+    >>> paths_in_output(b"a/My Messages.java\\nb.java\\n")
+    ['a/My Messages.java', 'b.java']
+    """
+    return [os.fsdecode(i) for i in output.splitlines() if i]
+
+
 def get_paths_to_all_NLS_classes(module_path):
     try:
-        return str(sp.check_output(shlex.split("ag 'class.*extends.*NLS' -G '.*java$' {} -l".format(module_path))), encoding="utf-8").split()
+        if shutil.which("rg") is None:
+            return paths_in_output(sp.check_output(
+                ["ag", "class.*extends.*NLS", "-G", ".*java$", module_path, "-l"]))
+        return _rg("-l", "-g", "*.java", "-e", "class.*extends.*NLS", module_path)
     except sp.CalledProcessError:
         return []
 
@@ -53,59 +77,99 @@ def all_java_files_in(module_path, exclude_paths):
     """
     exclude = set(exclude_paths)
     try:
-        paths = str(sp.check_output(shlex.split('find {} -iname "*.java"'.format(module_path))), encoding="utf-8").split()
+        if shutil.which("rg") is None:
+            paths = walk_java_files(module_path)
+        else:
+            # like find and walk_java_files, include hidden and ignored files
+            paths = _rg("--files", "--hidden", "--no-ignore", "--iglob", "*.java", module_path)
     except sp.CalledProcessError:
         paths = []
     return [p for p in paths if not p in exclude]
-    
+
+
+def walk_java_files(root):
+    """Find all Java files below root like find -iname "*.java", but without a subprocess.
+    >>> [os.path.basename(p) for p in sorted(walk_java_files(os.path.dirname(os.path.abspath(__file__))))]
+    ['FAKE.java', 'FAKE2.java']
+    """
+    paths = []
+    directories = [root]
+    while directories:
+        try:
+            entries = list(os.scandir(directories.pop()))
+        except OSError as e: # find also skips unreadable directories
+            logging.warning("Cannot list directory: %s", e)
+            continue
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                directories.append(entry.path)
+            elif entry.name.lower().endswith(".java"):
+                paths.append(entry.path)
+    return paths
+
+
+def files_mentioning_any(filepaths, literals):
+    """Keep only the files which contain at least one of the (bytes) literals.
+
+    Uses the multi-literal search of ripgrep, so most files never have to
+    be read by Python. Without rg all files are kept.
+    """
+    if shutil.which("rg") is None or not filepaths:
+        return filepaths
+    matching = set()
+    with tempfile.NamedTemporaryFile("wb", suffix=".txt") as f:
+        f.write(b"".join(i + b"\n" for i in literals))
+        f.flush()
+        try:
+            for start in range(0, len(filepaths), MAX_FILES_PER_RG_CALL):
+                matching.update(_rg("-l", "-F", "-f", f.name, "--",
+                                    *filepaths[start:start + MAX_FILES_PER_RG_CALL]))
+        except sp.CalledProcessError:
+            logging.warning("Pre-filtering with rg failed, processing all files")
+            return filepaths
+    return [p for p in filepaths if p in matching]
 
 
 def open_no_nl(filepath, mode="r"):
     """Open a file for reading without translating newlines."""
     return open(filepath, mode, newline="")
 
-def NLS_variable_lines(filepath):
-    lines = []
-    with open_no_nl(filepath) as f:
-        for i in f:
-            if re.search("public.*static.*String", i) and not "(" in i:
-                lines.append(i)
-    return lines
+NLS_VARIABLE_LINE = re.compile("public.*static.*String")
 
-def NLS_package(filepath):
+def parse_NLS(filepath):
+    """Read the variable lines and the package of an NLS class in one pass.
+    >>> filepath = "testfile-0f4bb8e1-58c6-4a0b-9e0e-3f2ab1c4d2a7"
+    >>> with open(filepath, "w") as f: f.write("package foo.bah;\\npublic class Bah extends NLS {\\n  public static String FOO;\\n  public static String get() {}\\n}\\n")
+    110
+    >>> parse_NLS(filepath)
+    (['  public static String FOO;\\n'], 'foo.bah')
+    >>> os.remove(filepath) # avoid leaking files
+    """
     lines = []
+    package = None
     with open_no_nl(filepath) as f:
         for i in f:
-            if i.startswith("package "):
-                return i[len("package "):].replace(";", "").strip()
-    raise ValueError("File %s has no package definition!", filepath)
+            if package is None and i.startswith("package "):
+                package = i[len("package "):].replace(";", "").strip()
+            elif NLS_VARIABLE_LINE.search(i) and not "(" in i:
+                lines.append(i)
+    if package is None:
+        raise ValueError("File %s has no package definition!", filepath)
+    return lines, package
 
 
 
-def remove_lines_from_file(filepath, lines):
+def remove_lines(content, lines):
     """
-    >>> lines = ["a\\n", "c\\n"]
-    >>> filepath = "testfile-7ba084fc-e760-44f3-9a21-e5b52eaa5c25"
-    >>> with open(filepath, "w") as f: f.write("a\\nb\\nc\\n")
-    6
-    >>> remove_lines_from_file(filepath, lines)
-    True
-    >>> with open(filepath) as f: f.read()
+    >>> remove_lines("a\\nb\\nc\\n", ["a\\n", "c\\n"])
     'b\\n'
-    >>> os.remove(filepath) # avoid leaking files
+    >>> remove_lines("x {// a\\nb\\n", ["a\\n"]) # only whole lines
+    'x {// a\\nb\\n'
     """
     linesset = set(lines)
-    towrite = []
-    changed = False
-    with open_no_nl(filepath) as f:
-        for i in f:
-            if i not in linesset:
-                towrite.append(i)
-            else:
-                changed = True
-    with open_no_nl(filepath, "w") as f:
-        f.writelines(towrite)
-    return changed
+    # split the lines like open_no_nl does when iterating the file
+    return "".join([i for i in io.StringIO(content, newline="")
+                    if i not in linesset])
 
 def filepath_to_classname(filepath):
     return os.path.splitext(os.path.basename(filepath))[0]
@@ -150,58 +214,164 @@ def build_replacement_patterns(filesandlines, filesandpackages):
     patterns = []
     
     for filepath, lines in sorted(filesandlines.items()):
+        classname = filepath_to_classname(filepath)
+        package = filesandpackages[filepath]
         for line in lines:
-            classname = filepath_to_classname(filepath)
             variablename = line_to_variable(line)
             fromstr = FROM.format(classname=classname, variablename=variablename)
             tostr = TO.format(classname=classname, variablename=variablename)
-            package = filesandpackages[filepath]
             patterns.append((fromstr, tostr, classname, variablename, package))
     # reverse sort by variable and fromstr to ensure that longest
-    # variables go first. This avoids partial replacements.
-    return list(reversed(sorted(patterns, key=lambda x: (len(x[3]), x[3], len(x[2]), x[0]))))
-
+    # variables go first. This avoids partial replacements. The position
+    # keeps equal patterns in reversed file order, as reversing the sorted
+    # list did, and ensures that the pattern tuples are never compared.
+    decorated = [(len(p[3]), p[3], len(p[2]), p[0], n, p)
+                 for n, p in enumerate(patterns)]
+    decorated.sort(reverse=True)
+    return [i[-1] for i in decorated]
 
-@functools.lru_cache(maxsize=1000000)
-def format_cached(formatstring, *args):
-    """calls formatstring.(*args)"""
-    return formatstring.format(*args)
 
+def add_import_statements(patterns):
+    """Extend the pattern tuples by the import statements to search and replace.
 
-@functools.lru_cache(maxsize=1000000)
-def regexp_cached(matchstring):
-    """use a larger cache for regexps. Note: this causes some double-caching, because regexp itself also caches."""
-    return re.compile(matchstring)
-
-
-def regex_replace_variable_safely(content, variablename, TO):
+    Creating them once avoids formatting them again for every file.
+    >>> add_import_statements([('Bah.FOO', 'Bah.getString("FOO")', 'Bah', 'FOO', 'foo')])
+    [('Bah.FOO', 'Bah.getString("FOO")', 'Bah', 'FOO', 'foo', 'import foo.Bah', 'import static foo.Bah.FOO', 'import static foo.Bah.*')]
+    """
+    return [(FROM, TO, classname, variablename, package,
+             "import {}.{}".format(package, classname),
+             "import static {}.{}".format(package, FROM),
+             "import static {}.{}.*".format(package, classname))
+            for FROM, TO, classname, variablename, package in patterns]
+
+
+def build_pattern_index(patterns, encoding=None):
+    """Map every literal which can make a pattern apply to a file to the positions of these patterns.
+
+    A pattern can only change a file which contains its variable. The
+    static star import of a class is replaced whenever one pattern of the
+    class is used, so it only needs to select the first one. The literals
+    are grouped by classname, because every change needs the classname in
+    the file.
+
+    :param encoding: if given, the literals are encoded to search raw file content.
+    >>> patterns = add_import_statements(
+    ...     [('Bah.FOO_thing', 'Bah.getString("FOO_thing")', 'Bah', 'FOO_thing', 'foo'),
+    ...      ('Bah.FOO_other', 'Bah.getString("FOO_other")', 'Bah', 'FOO_other', 'foo')])
+    >>> build_pattern_index(patterns)
+    {'Bah': {'FOO_thing': [0], 'import static foo.Bah.*': [0], 'FOO_other': [1]}}
+    >>> build_pattern_index(patterns, encoding="utf-8")
+    {b'Bah': {b'FOO_thing': [0], b'import static foo.Bah.*': [0], b'FOO_other': [1]}}
     """
-    >>> rrvs = regex_replace_variable_safely
+    index = {}
+    for n, (FROM, TO, classname, variablename, package,
+            classimport, staticimportvariable, staticimportstar) in enumerate(patterns):
+        if encoding is not None:
+            classname = classname.encode(encoding)
+            variablename = variablename.encode(encoding)
+            staticimportstar = staticimportstar.encode(encoding)
+        literals = index.setdefault(classname, {})
+        literals.setdefault(variablename, []).append(n)
+        if staticimportstar not in literals:
+            literals[staticimportstar] = [n]
+    return index
+
+
+def patterns_for_content(content, patterns, index):
+    """Select the patterns which can change the content, keeping their order.
+
+    Only the literals of classes named in the content are searched. The
+    content can be a string, bytes or a memory map of the file, matching
+    the type of the index literals.
+    >>> patterns = add_import_statements(
+    ...     [('Bah.FOO_thing', 'Bah.getString("FOO_thing")', 'Bah', 'FOO_thing', 'foo'),
+    ...      ('Bah.FOO_other', 'Bah.getString("FOO_other")', 'Bah', 'FOO_other', 'foo')])
+    >>> index = build_pattern_index(patterns)
+    >>> [i[3] for i in patterns_for_content("x = Bah.FOO_other;", patterns, index)]
+    ['FOO_other']
+    >>> [i[3] for i in patterns_for_content("import static foo.Bah.*;", patterns, index)]
+    ['FOO_thing']
+    >>> patterns_for_content("x = FOO_other;", patterns, index)
+    []
+    """
+    selected = set()
+    # mmap does not support "in" for substrings
+    for classname, literals in index.items():
+        if content.find(classname) == -1:
+            continue
+        for literal, positions in literals.items():
+            if content.find(literal) != -1:
+                selected.update(positions)
+    return [patterns[n] for n in sorted(selected)]
+
+
+# An identifier which is neither accessed via a class or an object nor
+# quoted. Matching any identifier and looking it up in a dict takes
+# linear time, while an alternation of all variables gets slower with
+# every variable, because re tries the alternatives one by one.
+UNQUALIFIED_IDENTIFIER = re.compile('(?<![."\\w$])((?:[^\\W\\d]|\\$)[\\w$]*)(?!["\\w$])')
+
+
+def regex_replace_variables_safely(content, TOs):
+    """Replace unqualified uses of the variables in TOs by their TO strings in one pass.
+    >>> rrvs = regex_replace_variables_safely
     >>> content = "messages.typeLabel = ObjectypeSelectionMessages_AttributeObjecttypeLabel;"
-    >>> rrvs(content, "ObjectypeSelectionMessages_AttributeObjecttypeLabel", 'Messages.getString("ObjectypeSelectionMessages_AttributeObjecttypeLabel")')
+    >>> rrvs(content, {"ObjectypeSelectionMessages_AttributeObjecttypeLabel": 'Messages.getString("ObjectypeSelectionMessages_AttributeObjecttypeLabel")'})
     'messages.typeLabel = Messages.getString("ObjectypeSelectionMessages_AttributeObjecttypeLabel");'
+    >>> rrvs('FOO_bar(FOO, Bah.FOO, "FOO", MY_FOO, 1FOO)', {"FOO": 'Bah.getString("FOO")'})
+    'FOO_bar(Bah.getString("FOO"), Bah.FOO, "FOO", MY_FOO, 1FOO)'
 
+    Adjacent uses and uses at the start or the end of the content need no
+    surrounding character:
+    >>> rrvs('FOO+FOO,BAR', {"FOO": 'Bah.getString("FOO")', "BAR": 'Bah.getString("BAR")'})
+    'Bah.getString("FOO")+Bah.getString("FOO"),Bah.getString("BAR")'
     """
-    # avoid replacing static-looking variables which are accessed via a class
-    variablewithoutdot = regexp_cached('[^\\."]' + variablename + '[^"]') # avoid stumbling over already quoted ones
-    variableatstart = regexp_cached('^[^"]' + variablename)
-    logging.debug("variable %s, without. %s, atstart %s", variablename, variablewithoutdot, variableatstart)
-    match = variablewithoutdot.search(content)
-    while match is not None and match.start() < len(content):
-        # manually replace the variable to avoid killing the first char in the match
-        logging.debug("matched regexp %s as matcher %s", variablewithoutdot, match)
-        content = content[:match.start() + 1] + TO + content[match.end() - 1:]
-        match = variablewithoutdot.search(content, match.end() + len(TO) - len(variablename) - 1)
-    match = variableatstart.search(content)
-    while match is not None and match.start() < len(content):
-        logging.debug("matched regexp %s as matcher %s", variableatstart, match)
-        content = content[:match.start()] + TO + content[match.end():]
-        match = variableatstart.search(content, match.end() + len(TO) - len(variablename))
-    return content
-    
-    
+    return UNQUALIFIED_IDENTIFIER.sub(lambda match: TOs.get(match.group(1), match.group(1)), content)
 
-def replace_NLS_usage(content, patterns):
+
+def build_FROM_matcher(patterns):
+    """Create a matcher which finds the FROM strings of all patterns in a single pass.
+
+    This is an Aho-Corasick automaton if pyahocorasick is installed,
+    otherwise a regular expression which tries longer FROM strings first.
+    The regular expression slows down with every alternative, so only
+    build it from the patterns selected for a file.
+    """
+    FROMs = sorted({i[0] for i in patterns}, key=len, reverse=True)
+    if ahocorasick is None:
+        return re.compile("|".join(re.escape(i) for i in FROMs) or "(?!)")
+    automaton = ahocorasick.Automaton()
+    for FROM in FROMs:
+        automaton.add_word(FROM, FROM)
+    automaton.make_automaton()
+    return automaton
+
+
+def replace_FROM_usage(content, patterns, FROM_matcher):
+    """Replace the FROM strings of the patterns by their TO strings in a single pass.
+
+    Where FROM strings overlap, the leftmost longest one wins.
+    >>> patterns = [('Bah.FOO_thing', 'Bah.getString("FOO_thing")', 'Bah', 'FOO_thing', 'foo'),
+    ...             ('Bah.FOO', 'Bah.getString("FOO")', 'Bah', 'FOO', 'foo')]
+    >>> replace_FROM_usage("a(Bah.FOO_thing, Bah.FOO);", patterns, build_FROM_matcher(patterns))
+    'a(Bah.getString("FOO_thing"), Bah.getString("FOO"));'
+    """
+    TOs = {i[0]: i[1] for i in patterns}
+    if not TOs:
+        return content
+    if ahocorasick is None:
+        return FROM_matcher.sub(lambda match: TOs.get(match.group(), match.group()), content)
+    pieces = []
+    start = 0
+    for end, FROM in FROM_matcher.iter_long(content):
+        pieces.append(content[start:end + 1 - len(FROM)])
+        pieces.append(TOs.get(FROM, FROM))
+        start = end + 1
+    pieces.append(content[start:])
+    return "".join(pieces)
+
+
+def replace_NLS_usage(content, patterns, FROM_matcher=None):
     """
     >>> content = '''package net.disy.repository.designer.selector.view;
     ...
@@ -217,7 +387,7 @@ def replace_NLS_usage(content, patterns):
     >>> classname = 'Messages'
     >>> variablename = 'ObjectypeSelectionMessages_AttributeObjecttypeLabel'
     >>> package = 'net.disy.repository.designer'
-    >>> patterns = [(FROM, TO, classname, variablename, package)]
+    >>> patterns = add_import_statements([(FROM, TO, classname, variablename, package)])
     >>> print(replace_NLS_usage(content, patterns))
     package net.disy.repository.designer.selector.view;
     <BLANKLINE>
@@ -243,8 +413,8 @@ def replace_NLS_usage(content, patterns):
     >>> classname = 'LaisMessages'
     >>> variablename = 'LaisErrorAggregator_AreaInMassnamenUnused'
     >>> package = 'net.disy.gis.lais.dialog'
-    >>> patterns = [(FROM, TO, classname, variablename, package)]
-    >>> patterns == [('LaisMessages.LaisErrorAggregator_AreaInMassnamenUnused', 'LaisMessages.getString("LaisErrorAggregator_AreaInMassnamenUnused")', 'LaisMessages', 'LaisErrorAggregator_AreaInMassnamenUnused', 'net.disy.gis.lais.dialog')]
+    >>> patterns = add_import_statements([(FROM, TO, classname, variablename, package)])
+    >>> patterns == [('LaisMessages.LaisErrorAggregator_AreaInMassnamenUnused', 'LaisMessages.getString("LaisErrorAggregator_AreaInMassnamenUnused")', 'LaisMessages', 'LaisErrorAggregator_AreaInMassnamenUnused', 'net.disy.gis.lais.dialog', 'import net.disy.gis.lais.dialog.LaisMessages', 'import static net.disy.gis.lais.dialog.LaisMessages.LaisErrorAggregator_AreaInMassnamenUnused', 'import static net.disy.gis.lais.dialog.LaisMessages.*')]
     True
     >>> print(replace_NLS_usage(content, patterns))
     package net.disy.gis.lais.dialog;
@@ -258,44 +428,43 @@ def replace_NLS_usage(content, patterns):
         }
     """
     replaced = set() # never replace the same twice
-    for FROM, TO, classname, variablename, package in patterns:
-        classimport = format_cached("import {}.{}", package, classname)
-        staticimport = format_cached("import static {}.{}", package, classname)
-        staticimportvariable = format_cached("import static {}.{}", package, FROM)
-        staticimportstar = format_cached("import static {}.{}.*", package, classname)
+    variableTOs = {} # unqualified variables to replace in one pass
+    starimported = {} # whether each star import is in the content
+    for (FROM, TO, classname, variablename, package,
+         classimport, staticimportvariable, staticimportstar) in patterns:
         logging.debug("FROM %s, TO %s, classname %s, variablename %s, package %s",
                       FROM, TO, classname, variablename, package)
-        logging.debug("staticimport %s", staticimport)
         logging.debug("staticimportvariable %s", staticimportvariable)
         logging.debug("staticimportstar %s", staticimportstar)
-        uses_static_variable_import_matcher = regexp_cached(staticimportvariable.replace(".", "\\."))
-        uses_static_star_import_matcher = regexp_cached(staticimportstar.replace(".", "\\.").replace("*", "\\*"))
         if staticimportvariable not in replaced:
-            if uses_static_variable_import_matcher.search(content) is not None:
+            if staticimportvariable in content:
                 replaced.add(staticimportvariable)
                 logging.debug("replace staticimport %s by %s", staticimportvariable, classimport)
                 content = content.replace(staticimportvariable, classimport)
+                starimported.clear() # the content changed
                 if variablename not in replaced:
                     replaced.add(variablename)
                     logging.debug("replace staticimportvariable %s by %s", variablename, TO)
-                    content = regex_replace_variable_safely(content, variablename, TO)
-        if uses_static_star_import_matcher.search(content) is not None:
+                    variableTOs[variablename] = TO
+        if staticimportstar not in starimported:
+            starimported[staticimportstar] = staticimportstar in content
+        if starimported[staticimportstar]:
             if variablename not in replaced:
                 replaced.add(variablename)
                 logging.debug("replace staticimportstarvariable %s by %s", variablename, TO)
-                content = regex_replace_variable_safely(content, variablename, TO)
-        if FROM not in replaced:
-            if FROM in content:
-                replaced.add(FROM)
-                logging.debug("replace FROM %s by %s", FROM, TO)
-                content = content.replace(FROM, TO)
+                variableTOs[variablename] = TO
+    if variableTOs:
+        content = regex_replace_variables_safely(content, variableTOs)
+    # replace FROM only after all static imports got replaced, so it
+    # cannot break static imports of equally named classes
+    if FROM_matcher is None:
+        FROM_matcher = build_FROM_matcher(patterns)
+    content = replace_FROM_usage(content, patterns, FROM_matcher)
     # must replace the importstar import in the end, because I use it
     # to detect whether we have a star import
-    for FROM, TO, classname, variablename, package in patterns:
-        classimport = format_cached("import {}.{}", package, classname)
-        staticimportstar = format_cached("import static {}.{}.*", package, classname)
-        uses_static_star_import_matcher = regexp_cached(staticimportstar.replace(".", "\\.").replace("*", "\\*"))
-        if uses_static_star_import_matcher.search(content) is not None:
+    for (FROM, TO, classname, variablename, package,
+         classimport, staticimportvariable, staticimportstar) in patterns:
+        if staticimportstar in content:
             if staticimportstar not in replaced:
                 replaced.add(staticimportstar)
                 logging.debug("replace staticimportstar %s by %s", staticimportstar, classimport)
@@ -304,12 +473,23 @@ def replace_NLS_usage(content, patterns):
 
 
 
-def replace_patterns_in_file(filepath, patterns):
-    """Replace the first element of every tuple in patterns with the second."""
+def replace_patterns_in_file(filepath, patterns, index, FROM_matcher):
+    """Replace the first element of every tuple in patterns with the second.
+
+    The index must contain encoded literals. They are searched in a memory
+    map of the file, so files without any of them are never decoded.
+    """
+    with open(filepath, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0: # empty files cannot be mapped
+            return False
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            patterns = patterns_for_content(mapped, patterns, index)
+    if not patterns:
+        return False
     with open_no_nl(filepath) as f:
         content = f.read()
     logging.info("replacing Message variable access with ResourceBundle calls in %s", filepath)
-    newcontent = replace_NLS_usage(content, patterns)
+    newcontent = replace_NLS_usage(content, patterns, FROM_matcher)
     changed = newcontent != content
     if changed:
         with open_no_nl(filepath, "w") as f:
@@ -368,6 +548,11 @@ def add_import_before(filepath):
     with open_no_nl(filepath, "w") as f:
         f.write(content)
 
+# indentation is kept as is, the first closing brace ends the block
+STATIC_BLOCK = re.compile(r"static \{[^}]*\}")
+TEMPLATE_RESOLVER = "private static final IMessageResolver MSG = new ResourceBundleMessageResolver(BUNDLE_NAME);"
+
+
 def replace_static_constructor_with_resolver(content):
     """
     >>> content = "\\nstatic {\\n moooooo\\n\\n     moo}\\n"
@@ -375,13 +560,10 @@ def replace_static_constructor_with_resolver(content):
     '\\nprivate static final IMessageResolver MSG = new ResourceBundleMessageResolver(BUNDLE_NAME);\\n'
 
     """
-    ResourceBundle = "private static final IMessageResolver MSG = new ResourceBundleMessageResolver(BUNDLE_NAME);"
-    static = "static {"
-    startidx = content.index(static) # I checked that this finds ALL instances, indentation is kept as is.
-    stopidx = content[startidx+len(static):].index("}")
-    return (content[:startidx]
-            + ResourceBundle
-            + content[startidx + len(static) + stopidx + 1:])
+    rewritten, count = STATIC_BLOCK.subn(lambda match: TEMPLATE_RESOLVER, content, count=1)
+    if not count:
+        raise ValueError("no static block found")
+    return rewritten
 
 def add_to_end_of_last_class(content, block=TEMPLATE_GETSTRING):
     """Add a getString method at the end of the file
@@ -390,17 +572,21 @@ def add_to_end_of_last_class(content, block=TEMPLATE_GETSTRING):
     'moo {\\n  {\\n\\n  }  abc\\n}'
     """
     endidx = content.rindex("\n}")
-    
-    return (content[:endidx]
-            + block
-            + content[endidx:])
-    
+    return "".join((content[:endidx], block, content[endidx:]))
+
+
+# lines are empty if they only contain whitespace
+MORE_THAN_TWO_EMPTY_LINES = re.compile(r"^([^\S\n]*\n[^\S\n]*\n)(?:[^\S\n]*\n)+", re.MULTILINE)
+TWO_EMPTY_LAST_LINES = re.compile(r"(^|\n)([^\S\n]*)\n[^\S\n]*\Z")
+
 
 def cleanup_empty_lines(content):
     """Allow at most two consecutive empty lines
     >>> content = 'abc\\n\\n\\n\\nbc\\n\\nc\\n\\n\\n\\nd\\n\\n'
     >>> cleanup_empty_lines(content)
     'abc\\n\\n\\nbc\\n\\nc\\n\\n\\nd\\n'
+    >>> cleanup_empty_lines('a\\n \\n\\t\\n  \\nb')
+    'a\\n \\n\\t\\nb'
     >>> content = '''-  static {
     ...     // initialize resource bundle
     ...     NLS.initializeMessages(BUNDLE_NAME, Messages.class);
@@ -411,22 +597,9 @@ def cleanup_empty_lines(content):
     >>> content + "\\n" == cleanup_empty_lines(content + "\\n")
     True
     """
-    lines = content.split("\n")
-    nlines = len(lines)
-    newlines = []
-    prev, prevprev = None, None
-    def all_empty(*args):
-        empty = [(l is not None
-                  and l.strip() == "")
-                 for l in args]
-        return not False in empty
-    for idx, line in enumerate(lines):
-        if (not all_empty(prevprev, prev, line)
-            and (idx != nlines - 1 or not all_empty(prev, line))):
-            newlines.append(line)
-        prevprev = prev
-        prev = line
-    return "\n".join(newlines)
+    content = MORE_THAN_TWO_EMPTY_LINES.sub(r"\1", content)
+    # a file ending in two empty lines loses the last one
+    return TWO_EMPTY_LAST_LINES.sub(r"\1\2", content)
 
 
 def rewrite_NLS_Messages_file(filepath, variablelines):
@@ -440,48 +613,58 @@ def rewrite_NLS_Messages_file(filepath, variablelines):
 - remove " extends NLS"
 """
     logging.info("rewriting Message file %s", filepath)
-    # first remove all the variable lines with efficient iteration over the lines
-    changed = remove_lines_from_file(filepath, variablelines)
-    # process the content of the NLS Message file in memory
+    # process the content of the NLS Message file in memory, so it is
+    # read and written only once
     with open_no_nl(filepath) as f:
-        content = f.read()
+        original = f.read()
+    content = remove_lines(original, variablelines)
     try:
         rewritten = replace_static_constructor_with_resolver(content)
     except ValueError:
         logging.warning("No static block found in file %s", filepath)
-        return False # not changed
+        if content != original: # the variable lines are removed nonetheless
+            with open_no_nl(filepath, "w") as f:
+                f.write(content)
+        return False # not rewritten
     rewritten = add_import_to_string(
         rewritten,
         existing_import="import org.eclipse.osgi.util.NLS")
     rewritten = add_to_end_of_last_class(rewritten, TEMPLATE_GETSTRING)
     rewritten = cleanup_empty_lines(rewritten)
     rewritten = rewritten.replace(" extends NLS", "")
-    changed = changed or rewritten != content
+    changed = rewritten != original
     if changed:
         with open_no_nl(filepath, "w") as f:
             f.write(rewritten)
     return changed
 
 
-def replace_patterns_in_filelist(filepaths, patterns):
-    return [replace_patterns_in_file(i, patterns)
-            for i in filepaths]
+# the shared state of the worker processes, set once per process by init_worker
+_PATTERNS = None
+_INDEX = None
+_FROM_MATCHER = None
+
+def init_worker(patterns, index, FROM_matcher):
+    global _PATTERNS, _INDEX, _FROM_MATCHER
+    _PATTERNS, _INDEX, _FROM_MATCHER = patterns, index, FROM_matcher
 
-def process_multiprocessing(sublists, patterns, usecpus):
-    with concurrent.futures.ProcessPoolExecutor(max_workers=usecpus) as e:
-        futures = []
-        for sub in sublists:
-            futures.append(e.submit(replace_patterns_in_filelist, sub, patterns))
-    changedusage = []
-    for fut in futures:
-        changedusage.extend(fut.result(timeout=900))
-    return changedusage
+def replace_patterns_in_worker_file(filepath):
+    return replace_patterns_in_file(filepath, _PATTERNS, _INDEX, _FROM_MATCHER)
 
-def process_single_process(sublists, patterns):
-    changedusage = []
-    for sub in sublists:
-        changedusage.extend(replace_patterns_in_filelist(sub, patterns))
-    return changedusage
+def process_multiprocessing(filepaths, patterns, index, FROM_matcher, usecpus):
+    import concurrent.futures # only needed here, keeps --test startup fast
+    # several chunks per worker, so a worker which got large files does
+    # not leave the others idle at the end
+    chunksize = max(1, len(filepaths) // (usecpus * 4))
+    # the tasks only carry file paths, the patterns reach every worker once
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=usecpus, initializer=init_worker,
+            initargs=(patterns, index, FROM_matcher)) as e:
+        return list(e.map(replace_patterns_in_worker_file, filepaths, chunksize=chunksize))
+
+def process_single_process(filepaths, patterns, index, FROM_matcher):
+    return [replace_patterns_in_file(i, patterns, index, FROM_matcher)
+            for i in filepaths]
 
 
 def main(args):
@@ -493,24 +676,27 @@ def main(args):
     filesandlines = {}
     filesandpackages = {}
     for i in NLS_files:
-        filesandlines[i] = NLS_variable_lines(i)
-    for i in NLS_files:
-        filesandpackages[i] = NLS_package(i)
-    patterns = build_replacement_patterns(filesandlines, filesandpackages)
+        filesandlines[i], filesandpackages[i] = parse_NLS(i)
+    patterns = add_import_statements(
+        build_replacement_patterns(filesandlines, filesandpackages))
     # logging.debug("All patterns: %s", patterns)
     alljavafiles = []
     for module_path in module_paths:
         alljavafiles.extend(all_java_files_in(module_path, exclude_paths=NLS_files))
-    usecpus = 2 * multiprocessing.cpu_count()
-    listcount = 3 * usecpus
-    # process the files in order: distribute them in order between the processes
-    sublists = [[] for i in range(listcount)]
-    for n, i in enumerate(alljavafiles):
-        sublists[n % listcount].append(i)
+    # literals encoded like open() decodes the files
+    index = build_pattern_index(patterns, encoding=locale.getpreferredencoding(False))
+    # only files which mention a variable or star import can change
+    alljavafiles = files_mentioning_any(
+        alljavafiles, {i for literals in index.values() for i in literals})
+    # a regex over all FROM strings is slow on every file, so without
+    # pyahocorasick each file gets a regex of only its selected patterns
+    FROM_matcher = build_FROM_matcher(patterns) if ahocorasick is not None else None
     if args.singleprocess:
-        changedusage = process_single_process(sublists, patterns)
+        changedusage = process_single_process(alljavafiles, patterns, index, FROM_matcher)
     else:
-        changedusage = process_multiprocessing(sublists, patterns, usecpus)
+        import multiprocessing
+        usecpus = 2 * multiprocessing.cpu_count()
+        changedusage = process_multiprocessing(alljavafiles, patterns, index, FROM_matcher, usecpus)
     changedmessage = [rewrite_NLS_Messages_file(i, filesandlines[i])
                       for i in NLS_files]
     return changedusage, changedmessage
@@ -518,18 +704,20 @@ def main(args):
 
 
 # output test results as base60 number (for aesthetics)
-def numtosxg(n):
-    CHARACTERS = ('0123456789'
+SXG_CHARACTERS = ('0123456789'
                   'ABCDEFGHJKLMNPQRSTUVWXYZ'
                   '_'
                   'abcdefghijkmnopqrstuvwxyz')
-    s = ''
+
+
+def numtosxg(n):
     if not isinstance(n, int) or n == 0:
         return '0'
+    digits = []
     while n > 0:
         n, i = divmod(n, 60)
-        s = CHARACTERS[i] + s
-    return s
+        digits.append(SXG_CHARACTERS[i])
+    return ''.join(reversed(digits))
 
 
 def _test(args):
@@ -541,6 +729,9 @@ def _test(args):
     else: return ":( "*tests.failed
     
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING,
+                        format=' [%(levelname)-7s] (%(asctime)s) %(filename)s::%(lineno)d %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S')
     args = parser.parse_args()
     if args.debug:
         logging.getLogger().setLevel(logging.DEBUG)
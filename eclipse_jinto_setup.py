@@ -6,51 +6,88 @@ Creates the files PROJECT/.settings/de.guhsoft.jinto.core.prefs and a tarball wi
 
 Example usage: ./eclipse_jinto_setup.py -p ~/eclipse-workspace/cadenza-trunk/cadenza -t ~/eclipse-workspace/cadenza-trunk/jinto-init.tar.gz ~/eclipse-workspace/cadenza-trunk/cadenza/*/
 
-Requirements: The Silver Surfer (ag).
+Requirements: Python3.
 """
 
 import argparse
 import subprocess as sp
 import os
-import shlex
+import sys
+import shutil
+import mmap
+import tarfile
+import locale
 import re
 import logging
 import functools
 import multiprocessing
 import concurrent.futures
-logging.basicConfig(level=logging.INFO,
-                    format=' [%(levelname)-7s] (%(asctime)s) %(filename)s::%(lineno)d %(message)s',
-                    datefmt='%Y-%m-%d %H:%M:%S')
 
 BUNDLE_DECLARATION = "private static final String BUNDLE_NAME"
 CLASS_DECLARATION = "public class "
+MESSAGES_CLASS = re.compile(rb"static.*final.*IMessageResolver.*MSG.*=")
+# the first line with each declaration, each is cleaned up afterwards
+PACKAGE_LINE = re.compile(rb"^[^\S\n]*package.*", re.MULTILINE)
+BUNDLE_LINE = re.compile(rb"^.*" + re.escape(BUNDLE_DECLARATION.encode()) + rb".*", re.MULTILINE)
+CLASS_LINE = re.compile(rb"^.*" + re.escape(CLASS_DECLARATION.encode()) + rb".*", re.MULTILINE)
+# characters to delete from the matched lines
+DELETE_SEMICOLON = str.maketrans("", "", ";")
+DELETE_QUOTES_EQUALS_SEMICOLON = str.maketrans("", "", '"=;')
+DELETE_BRACE = str.maketrans("", "", "{")
 
 TEMPLATE = """de.guhsoft.jinto.core.accessorConfiguration=<?xml version\\="1.0" encoding\\="UTF-8"?>\\n<root>\\n{resource_bundle_reference}\\n</root>
 eclipse.preferences.version=1
 """
+# the parts around the field of the template, so it is parsed only once
+TEMPLATE_START, TEMPLATE_END = TEMPLATE.split("{resource_bundle_reference}")
 
 TEMPLATE_RESOURCE_BUNDLE_REFERENCE_TAG = """<resourceBundleReference resourceBundleName\\="{properties}">\\n<accessor typeName\\="{accessor}">\\n<methodReference methodName\\="getString">\\n<parameter index\\="0" isSelected\\="true" parameterName\\="key" parameterType\\="java.lang.String"/>\\n</methodReference>\\n</accessor>\\n</resourceBundleReference>"""
+# the parts around the fields of the template, so it is parsed only once
+(TEMPLATE_RESOURCE_BUNDLE_REFERENCE_TAG_START,
+ TEMPLATE_RESOURCE_BUNDLE_REFERENCE_TAG_MIDDLE,
+ TEMPLATE_RESOURCE_BUNDLE_REFERENCE_TAG_END) = re.split(
+     r"\{properties\}|\{accessor\}", TEMPLATE_RESOURCE_BUNDLE_REFERENCE_TAG)
 
-parser = argparse.ArgumentParser()
-parser.add_argument("module_paths", nargs='+',
-                    help="The paths to the directories of the projects to process (a project is a folder which can have a .settings folder that gets recognized in Eclipse)")
-parser.add_argument("--debug", action="store_true",
-                    help="Set log level to debug")
-parser.add_argument("--info", action="store_true",
-                    help="Set log level to info")
-parser.add_argument("-p", "--parent-directory",
-                    help="The path to the parent directory of the modules, files will be stored relative to this")
-parser.add_argument("-t", "--target-tarball-path",
-                    help="The path to the tarball to create")
-parser.add_argument("--test", action="store_true",
-                    help="Run tests")
-
-
-def get_paths_to_all_Messages_classes(module_path):
+
+def build_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("module_paths", nargs='+',
+                        help="The paths to the directories of the projects to process (a project is a folder which can have a .settings folder that gets recognized in Eclipse)")
+    parser.add_argument("--debug", action="store_true",
+                        help="Set log level to debug")
+    parser.add_argument("--info", action="store_true",
+                        help="Set log level to info")
+    parser.add_argument("-p", "--parent-directory",
+                        help="The path to the parent directory of the modules, files will be stored relative to this")
+    parser.add_argument("-t", "--target-tarball-path",
+                        help="The path to the tarball to create")
+    parser.add_argument("--test", action="store_true",
+                        help="Run tests")
+    return parser
+
+
+def java_files_in(module_path):
+    """Walk the Java files below module_path in sorted order.
+    >>> [os.path.basename(p) for p in java_files_in(os.path.dirname(os.path.abspath(__file__)))]
+    ['FAKE.java', 'FAKE2.java']
+    """
     try:
-        return str(sp.check_output(shlex.split("ag 'static.*final.*IMessageResolver.*MSG.*=' -G '.*java$' {} -l".format(module_path))), encoding="utf-8").split()
-    except sp.CalledProcessError:
-        return []
+        with os.scandir(module_path) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+    except OSError as e: # like os.walk, skip unreadable directories
+        logging.warning("Cannot list directory: %s", e)
+        return
+    directories = []
+    for entry in entries:
+        # like ag, skip hidden directories and files and do not follow symlinks
+        if entry.name.startswith("."):
+            continue
+        if entry.is_dir(follow_symlinks=False):
+            directories.append(entry.path)
+        elif entry.name.endswith("java") and entry.is_file(follow_symlinks=False):
+            yield entry.path
+    for directory in directories:
+        yield from java_files_in(directory)
 
 
 def process_bundle_template(accessor, properties):
@@ -62,8 +99,9 @@ def process_bundle_template(accessor, properties):
     >>> process_bundle_template("net.disy.cadenza.desktop.Messages", "net.disy.cadenza.desktop.messages")
     '<resourceBundleReference resourceBundleName\\\\="net.disy.cadenza.desktop.messages">\\\\n<accessor typeName\\\\="net.disy.cadenza.desktop.Messages">\\\\n<methodReference methodName\\\\="getString">\\\\n<parameter index\\\\="0" isSelected\\\\="true" parameterName\\\\="key" parameterType\\\\="java.lang.String"/>\\\\n</methodReference>\\\\n</accessor>\\\\n</resourceBundleReference>'
 """
-    return TEMPLATE_RESOURCE_BUNDLE_REFERENCE_TAG.format(accessor=accessor,
-                                                         properties=properties)
+    return (f"{TEMPLATE_RESOURCE_BUNDLE_REFERENCE_TAG_START}{properties}"
+            f"{TEMPLATE_RESOURCE_BUNDLE_REFERENCE_TAG_MIDDLE}{accessor}"
+            f"{TEMPLATE_RESOURCE_BUNDLE_REFERENCE_TAG_END}")
 
 def generate_settings_data(accessors_and_properties):
     """
@@ -73,114 +111,210 @@ def generate_settings_data(accessors_and_properties):
     >>> generate_settings_data([('Ac', 'Ap'), ('Bc', 'Bp')])
     'de.guhsoft.jinto.core.accessorConfiguration=<?xml version\\\\="1.0" encoding\\\\="UTF-8"?>\\\\n<root>\\\\n<resourceBundleReference resourceBundleName\\\\="Ap">\\\\n<accessor typeName\\\\="Ac">\\\\n<methodReference methodName\\\\="getString">\\\\n<parameter index\\\\="0" isSelected\\\\="true" parameterName\\\\="key" parameterType\\\\="java.lang.String"/>\\\\n</methodReference>\\\\n</accessor>\\\\n</resourceBundleReference>\\\\n<resourceBundleReference resourceBundleName\\\\="Bp">\\\\n<accessor typeName\\\\="Bc">\\\\n<methodReference methodName\\\\="getString">\\\\n<parameter index\\\\="0" isSelected\\\\="true" parameterName\\\\="key" parameterType\\\\="java.lang.String"/>\\\\n</methodReference>\\\\n</accessor>\\\\n</resourceBundleReference>\\\\n</root>\\neclipse.preferences.version=1\\n'
     """
-    return TEMPLATE.format(
-        resource_bundle_reference="\\n".join(
-            process_bundle_template(accessor, properties)
-            for accessor, properties in accessors_and_properties))
+    # join builds a list from a generator anyway
+    return "".join((TEMPLATE_START,
+                    "\\n".join([process_bundle_template(accessor, properties)
+                                 for accessor, properties in accessors_and_properties]),
+                    TEMPLATE_END))
 
 def all_accessors_and_properties(module_path):
     """Finds all classes and assosiated properties files under the path.
 
+    The files are read in a few threads, so their reads overlap.
+
     :returns: [(accessor, properties), ...]
+    >>> all_accessors_and_properties(os.path.dirname(os.path.abspath(__file__)))
+    []
     """
-    return get_paths_to_all_Messages_classes(module_path)
+    # few threads: reading is I/O bound, and each keeps a file open
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as e:
+        results = e.map(accessor_and_properties_in, java_files_in(module_path))
+        return [i for i in results if i is not None]
 
-    
-def extract_accessor_and_properties(filepath):
-    """:returns: (accessor, properties)"""
-    package = None
-    properties = None
-    classname = None
-    with open(filepath) as f:
-        for line in f:
-            if package is None and line.strip().startswith("package"):
-                package = line.replace(";", "").replace("package", "").strip()
-            if properties is None and BUNDLE_DECLARATION in line:
-                properties = line.replace(
-                    BUNDLE_DECLARATION, "").replace(
-                        '"', '').replace(
-                            '=', '').replace(
-                                ";", "").strip()
-                # remove possibly included comments
-                if "/" in properties:
-                    properties = properties[:properties.index("/")].strip()
-            if classname is None and CLASS_DECLARATION in line:
-                classname = line.replace(
-                    CLASS_DECLARATION, "").replace(
-                        '{', '').strip()
-            if package is not None and properties is not None and classname is not None:
-                break
+
+def accessor_and_properties_in(filepath):
+    """Every Java file is opened only once: it is searched for a message
+    resolver and, if it declares one, parsed from the same memory map.
+
+    :returns: (accessor, properties) or None if the file declares no message resolver.
+    """
+    try:
+        f = open(filepath, "rb")
+    except OSError as e: # like ag, skip unreadable files
+        logging.warning("Cannot read file: %s", e)
+        return None
+    with f:
+        if os.fstat(f.fileno()).st_size == 0: # empty files cannot be mapped
+            return None
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            # the literal find is much cheaper than the regex
+            if mm.find(b"IMessageResolver") != -1 and MESSAGES_CLASS.search(mm):
+                return extract_accessor_and_properties(filepath, mm)
+    return None
+
+
+def extract_accessor_and_properties(filepath, content):
+    """:returns: (accessor, properties)
+    >>> extract_accessor_and_properties("Messages.java", b'''package net.x;
+    ... public class Messages {
+    ...   private static final String BUNDLE_NAME = "net.x.messages"; //$NON-NLS-1$
+    ... ''')
+    ('net.x.Messages', 'net.x.messages')
+    """
+    # decode only the matched lines, like open() does by default
+    encoding = locale.getpreferredencoding(False)
+    package = PACKAGE_LINE.search(content)
     if package is None:
         raise ValueError("File %s misses package identifier: %s.", filepath)
+    package = str(package.group(), encoding=encoding).translate(DELETE_SEMICOLON).replace("package", "").strip()
+    properties = BUNDLE_LINE.search(content)
     if properties is None:
         raise ValueError("File %s misses properties identifier: %s.", filepath)
+    properties = str(properties.group(), encoding=encoding).replace(
+        BUNDLE_DECLARATION, "").translate(DELETE_QUOTES_EQUALS_SEMICOLON).strip()
+    # remove possibly included comments
+    if "/" in properties:
+        properties = properties[:properties.index("/")].strip()
+    classname = CLASS_LINE.search(content)
     if classname is None:
         raise ValueError("File %s misses class identifier: %s.", filepath)
+    classname = str(classname.group(), encoding=encoding).replace(
+        CLASS_DECLARATION, "").translate(DELETE_BRACE).strip()
     return package+"."+classname, properties
 
 
 def write_jinto_settings_file(module_path, data):
     """:returns: the path to the settings file."""
-    settings_dirpath = os.path.join(module_path, ".settings")
-    settings_filepath = os.path.join(settings_dirpath, "de.guhsoft.jinto.core.prefs")
+    # module_path is absolute and has no trailing separator
+    settings_dirpath = f"{module_path}{os.sep}.settings"
+    settings_filepath = f"{settings_dirpath}{os.sep}de.guhsoft.jinto.core.prefs"
+    os.makedirs(settings_dirpath, exist_ok=True)
+    # O_EXCL checks for an existing file and creates it in one step
     try:
-        os.makedirs(settings_dirpath)
+        fd = os.open(settings_filepath, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
     except FileExistsError:
-        pass # no need to do anything
-    if os.path.exists(settings_filepath):
         logging.error("Not writing settings file %s : file already exists. What would have been written: %s", settings_filepath, data)
-    else:
-        with open(settings_filepath, "w") as f:
-            f.write(data)
-        return settings_filepath
+        return None
+    try:
+        try:
+            remaining = memoryview(data.encode("utf-8"))
+            while remaining: # os.write may write less than given
+                remaining = remaining[os.write(fd, remaining):]
+        finally:
+            os.close(fd)
+    except BaseException:
+        # an incomplete file would block every later run
+        os.unlink(settings_filepath)
+        raise
+    return settings_filepath
 
 def create_tarball(tarball_path, file_paths, base_path):
-    cmd = ('cd "{}" && tar -czf "{}" '.format(base_path, tarball_path)
-           + ' '.join('"' + p + '"'
-                      for p in file_paths))
-    logging.debug(cmd)
+    """Pack the files, given relative to base_path, into a gzipped tarball.
+
+    A relative tarball_path is relative to base_path, like with cd base_path && tar.
+
+    :returns: the path to the tarball.
+    """
+    if tarball_path is None or not file_paths: # tar refuses to create an empty archive
+        logging.warning("Not creating tarball %s with files %s", tarball_path, file_paths)
+        return None
+    tarball_path = os.path.join(base_path, tarball_path)
+    logging.debug("Creating tarball %s with files %s", tarball_path, file_paths)
+    created = False
+    try:
+        with open(tarball_path, "wb") as f:
+            created = True
+            if shutil.which("pigz") is None:
+                with tarfile.open(fileobj=f, mode="w:gz", compresslevel=6) as tf:
+                    add_to_tarball(tf, file_paths, base_path)
+            else:
+                compress_with_pigz(f, file_paths, base_path)
+    # like the tar call failing, for example in a missing directory
+    except (OSError, tarfile.TarError, sp.CalledProcessError) as e:
+        logging.error("Creating tarball %s failed: %s", tarball_path, e)
+        if created: # do not leave a partial tarball
+            try:
+                os.remove(tarball_path)
+            except OSError:
+                pass # nothing left to clean up
+        return None
+    return tarball_path
+
+
+def compress_with_pigz(f, file_paths, base_path):
+    """Stream the uncompressed tar into pigz, which compresses on all cores."""
+    proc = sp.Popen(["pigz", "-p", str(os.cpu_count() or 1)], stdin=sp.PIPE, stdout=f)
     try:
-        return str(sp.check_output(cmd, shell=True), encoding="utf-8").split()
-    except sp.CalledProcessError:
+        with tarfile.open(fileobj=proc.stdin, mode="w|") as tf:
+            add_to_tarball(tf, file_paths, base_path)
+        proc.stdin.close()
+    except (OSError, tarfile.TarError) as e: # BrokenPipeError if pigz exits early
+        try:
+            proc.stdin.close() # let pigz finish
+        except OSError:
+            pass # the pipe is already broken
+        if proc.wait():
+            raise sp.CalledProcessError(proc.returncode, proc.args) from e
+        raise
+    if proc.wait():
+        raise sp.CalledProcessError(proc.returncode, proc.args)
+
+
+def add_to_tarball(tf, file_paths, base_path):
+    for p in file_paths:
+        tf.add(os.path.join(base_path, p), arcname=p)
+
+
+def process_module(module_path, parent_directory):
+    """Write the settings file of one module.
+
+    :returns: [path of the settings file relative to parent_directory], empty if none was written.
+    """
+    if not os.path.isdir(module_path):
+        logging.warning("Not a directory %s", module_path)
+        return []
+    accessors_and_properties = all_accessors_and_properties(module_path)
+    if not accessors_and_properties:
         return []
+    data = generate_settings_data(accessors_and_properties)
+    filepath = write_jinto_settings_file(module_path, data)
+    if filepath is None:
+        return []
+    return [os.path.relpath(filepath, parent_directory)]
 
 
 def main(args):
     # enforce absolute path (interpreted the same by different tools)
     module_paths = [os.path.abspath(i) for i in args.module_paths]
-    file_paths = []
-    for module_path in module_paths:
-        if not os.path.isdir(module_path):
-            logging.warn("Not a directory %s", module_path)
-            continue
-        filepaths = get_paths_to_all_Messages_classes(module_path)
-        accessors_and_properties = [extract_accessor_and_properties(i) for i in filepaths]
-        if accessors_and_properties:
-            data = generate_settings_data(accessors_and_properties)
-            filepath = write_jinto_settings_file(module_path, data)
-            if filepath is not None:
-                relpath = os.path.relpath(filepath, args.parent_directory)
-                file_paths.append(relpath)
+    # the modules are independent, so process them in parallel
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=multiprocessing.cpu_count()) as e:
+        results = e.map(functools.partial(process_module,
+                                          parent_directory=args.parent_directory),
+                        module_paths)
+        file_paths = [relpath for result in results for relpath in result]
     logging.info("Files created:")
-    print("\n".join(os.path.join(args.parent_directory, i)
-                    for i in file_paths
-                    if i is not None))
+    # process_module only returns written files, so there is no None to skip
+    sys.stdout.write("\n".join([os.path.join(args.parent_directory, i)
+                                for i in file_paths]) + "\n")
     create_tarball(args.target_tarball_path, file_paths, args.parent_directory)
 
 
 # output test results as base60 number (for aesthetics)
-def numtosxg(n):
-    CHARACTERS = ('0123456789'
+SXG_CHARACTERS = ('0123456789'
                   'ABCDEFGHJKLMNPQRSTUVWXYZ'
                   '_'
                   'abcdefghijkmnopqrstuvwxyz')
-    s = ''
+
+
+def numtosxg(n):
     if not isinstance(n, int) or n == 0:
         return '0'
+    digits = []
     while n > 0:
         n, i = divmod(n, 60)
-        s = CHARACTERS[i] + s
-    return s
+        digits.append(SXG_CHARACTERS[i])
+    return ''.join(reversed(digits))
 
 
 def _test(args):
@@ -192,7 +326,10 @@ def _test(args):
     else: return ":( "*tests.failed
     
 if __name__ == "__main__":
-    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO,
+                        format=' [%(levelname)-7s] (%(asctime)s) %(filename)s::%(lineno)d %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S')
+    args = build_parser().parse_args()
     if args.debug:
         logging.getLogger().setLevel(logging.DEBUG)
     if args.info: